@@ -1,26 +1,62 @@
 package main
 
 import (
-	"fmt"
+	"flag"
 	"log"
+	"net"
+	"net/url"
 	"os"
 
 	"gorm.io/driver/postgres"
 	"gorm.io/gorm"
 )
 
+type indexInfo struct {
+	IndexName string `gorm:"column:indexname"`
+	TableName string `gorm:"column:tablename"`
+	IndexDef  string `gorm:"column:indexdef"`
+}
+
 func main() {
-	// Database connection parameters
-	host := "192.168.110.68"
-	port := "5432"
-	dbname := "sufeshopbot"
-	user := "sufeshopbot"
-	password := "ooaK3Wj4XLW9x&bXfRRv##"
-	sslmode := "disable"
-
-	// Build DSN
-	dsn := fmt.Sprintf("host=%s port=%s user=%s password=%s dbname=%s sslmode=%s",
-		host, port, user, password, dbname, sslmode)
+	verify := flag.Bool("verify", false, "re-query pg_indexes after the changes instead of reporting the expected state")
+	flag.Parse()
+
+	// Database connection parameters, using the same variables as the bot
+	host := getEnv("DB_HOST", "localhost")
+	port := getEnv("DB_PORT", "5432")
+	dbname := getEnv("DB_NAME", "")
+	user := getEnv("DB_USER", "")
+	password := getEnv("DB_PASSWORD", "")
+	sslmode := getEnv("DB_SSL_MODE", "disable")
+
+	if dbname == "" || user == "" {
+		log.Fatal("DB_NAME and DB_USER must be set")
+	}
+
+	// Timeouts are sent as session parameters so the catalog lookups and the
+	// duplicate check fail fast instead of queueing behind long-running
+	// transactions; any such failure is fatal. The concurrent index DDL runs
+	// without them, see execWithoutTimeouts
+	lockTimeout := getEnv("DB_LOCK_TIMEOUT", "5s")
+	statementTimeout := getEnv("DB_STATEMENT_TIMEOUT", "30s")
+
+	// Build DSN as a URL so values containing spaces, quotes or an empty
+	// password are escaped correctly
+	query := url.Values{}
+	query.Set("sslmode", sslmode)
+	query.Set("lock_timeout", lockTimeout)
+	query.Set("statement_timeout", statementTimeout)
+	dsnURL := url.URL{
+		Scheme:   "postgres",
+		User:     url.UserPassword(user, password),
+		Host:     net.JoinHostPort(host, port),
+		Path:     "/" + dbname,
+		RawQuery: query.Encode(),
+	}
+	if password == "" {
+		dsnURL.User = url.User(user)
+	}
+	dsn := dsnURL.String()
 
 	// Connect to database
 	db, err := gorm.Open(postgres.Open(dsn), &gorm.Config{})
@@ -35,14 +71,14 @@ func main() {
 	}
 	defer sqlDB.Close()
 
+	// The migration runs its statements one after another, so a single
+	// connection is enough
+	sqlDB.SetMaxOpenConns(1)
+
 	log.Println("Connected to database successfully")
 
 	// Step 1: Check current indexes
-	var indexes []struct {
-		IndexName string `gorm:"column:indexname"`
-		TableName string `gorm:"column:tablename"`
-		IndexDef  string `gorm:"column:indexdef"`
-	}
+	var indexes []indexInfo
 
 	err = db.Raw(`
 		SELECT indexname, tablename, indexdef 
@@ -60,83 +96,166 @@ func main() {
 		log.Printf("- %s: %s", idx.IndexName, idx.IndexDef)
 	}
 
-	// Step 2: Drop the old unique constraint if it exists
-	err = db.Exec("DROP INDEX IF EXISTS idx_message_templates_code").Error
-	if err != nil {
-		log.Printf("Warning: Failed to drop old index (may not exist): %v", err)
-	} else {
-		log.Println("\nDropped old index 'idx_message_templates_code' (if existed)")
+	// Step 2: Make sure no duplicate (code, language) combinations would
+	// block the unique index before touching any existing index
+	var duplicates []struct {
+		Code     string
+		Language string
+		Count    int
 	}
 
-	// Step 3: Create new composite unique index
-	// First, let's check if idx_code_lang already exists
-	var existingIndex struct {
-		Count int
-	}
 	err = db.Raw(`
-		SELECT COUNT(*) as count
-		FROM pg_indexes 
-		WHERE tablename = 'message_templates' 
-		AND indexname = 'idx_code_lang'
-		AND schemaname = 'public'
-	`).Scan(&existingIndex).Error
+		SELECT code, language, COUNT(*) as count
+		FROM message_templates
+		GROUP BY code, language
+		HAVING COUNT(*) > 1
+		ORDER BY code, language
+		LIMIT 20
+	`).Scan(&duplicates).Error
+
+	if err != nil {
+		log.Fatalf("Failed to check for duplicates: %v", err)
+	}
+	if len(duplicates) > 0 {
+		log.Println("\nERROR: Found duplicate (code, language) combinations (showing at most the first 20):")
+		for _, dup := range duplicates {
+			log.Printf("- Code: %s, Language: %s, Count: %d", dup.Code, dup.Language, dup.Count)
+		}
+		log.Println("Resolve these duplicates before creating the unique index.")
+		os.Exit(1)
+	}
 
+	// Step 3: Create new composite unique index before dropping the old one,
+	// so the table keeps a unique index if the build fails
+	// CONCURRENTLY cannot run inside a transaction; each Exec here is autocommitted
+	exists, valid, err := codeLangIndexState(db)
 	if err != nil {
 		log.Fatalf("Failed to check for existing index: %v", err)
 	}
 
-	if existingIndex.Count > 0 {
+	created := false
+	if exists && valid {
 		log.Println("\nComposite index 'idx_code_lang' already exists!")
 	} else {
-		err = db.Exec("CREATE UNIQUE INDEX idx_code_lang ON message_templates (code, language)").Error
+		if exists {
+			// A previously interrupted concurrent build leaves an invalid index behind
+			err = execWithoutTimeouts(db, "DROP INDEX CONCURRENTLY idx_code_lang")
+			if err != nil {
+				log.Fatalf("Failed to drop invalid composite index: %v", err)
+			}
+			log.Println("\nDropped invalid index 'idx_code_lang' left by an earlier run")
+		}
+
+		// CONCURRENTLY avoids holding an exclusive lock on the table while the index builds
+		err = execWithoutTimeouts(db, "CREATE UNIQUE INDEX CONCURRENTLY idx_code_lang ON message_templates (code, language)")
 		if err != nil {
 			log.Fatalf("Failed to create new composite index: %v", err)
 		}
+
+		// Only rely on the new index once PostgreSQL has marked it valid
+		exists, valid, err = codeLangIndexState(db)
+		if err != nil {
+			log.Fatalf("Failed to check new composite index: %v", err)
+		}
+		if !exists || !valid {
+			log.Fatal("Composite index 'idx_code_lang' is not valid; keeping the old index")
+		}
+		created = true
 		log.Println("\nCreated new composite unique index 'idx_code_lang' on (code, language)")
 	}
 
-	// Step 4: Verify the changes
-	err = db.Raw(`
-		SELECT indexname, tablename, indexdef 
-		FROM pg_indexes 
-		WHERE tablename = 'message_templates' 
-		AND schemaname = 'public'
-	`).Scan(&indexes).Error
-
+	// Step 4: Drop the old unique constraint now that idx_code_lang is in place
+	// A failed concurrent drop can leave the old index in place and still
+	// enforcing uniqueness on code alone, so it must not be reported as success.
+	// idx_code_lang is already valid at this point, so re-running is safe
+	err = execWithoutTimeouts(db, "DROP INDEX CONCURRENTLY IF EXISTS idx_message_templates_code")
 	if err != nil {
-		log.Fatalf("Failed to query indexes after changes: %v", err)
+		log.Fatalf("Failed to drop old index 'idx_message_templates_code', re-run the tool to retry: %v", err)
+	}
+	log.Println("\nDropped old index 'idx_message_templates_code' (if existed)")
+
+	// Step 5: Report the final state, derived from Step 1 unless -verify is set
+	var final []indexInfo
+	if *verify {
+		err = db.Raw(`
+			SELECT indexname, tablename, indexdef 
+			FROM pg_indexes 
+			WHERE tablename = 'message_templates' 
+			AND schemaname = 'public'
+		`).Scan(&final).Error
+
+		if err != nil {
+			log.Fatalf("Failed to query indexes after changes: %v", err)
+		}
+	} else {
+		for _, idx := range indexes {
+			if idx.IndexName == "idx_message_templates_code" || (created && idx.IndexName == "idx_code_lang") {
+				continue
+			}
+			final = append(final, idx)
+		}
+		if created {
+			final = append(final, indexInfo{
+				IndexName: "idx_code_lang",
+				TableName: "message_templates",
+				IndexDef:  "CREATE UNIQUE INDEX idx_code_lang ON public.message_templates USING btree (code, language)",
+			})
+		}
 	}
 
 	log.Println("\nFinal indexes on message_templates table:")
-	for _, idx := range indexes {
+	for _, idx := range final {
 		log.Printf("- %s: %s", idx.IndexName, idx.IndexDef)
 	}
 
-	// Check for any duplicate (code, language) combinations
-	var duplicates []struct {
-		Code     string
-		Language string
-		Count    int
-	}
+	log.Println("\nConstraint fix completed successfully!")
+}
 
-	err = db.Raw(`
-		SELECT code, language, COUNT(*) as count
-		FROM message_templates
-		GROUP BY code, language
-		HAVING COUNT(*) > 1
-	`).Scan(&duplicates).Error
+func getEnv(key, defaultValue string) string {
+	if value := os.Getenv(key); value != "" {
+		return value
+	}
+	return defaultValue
+}
 
-	if err != nil {
-		log.Printf("Warning: Failed to check for duplicates: %v", err)
-	} else if len(duplicates) > 0 {
-		log.Println("\nWARNING: Found duplicate (code, language) combinations:")
-		for _, dup := range duplicates {
-			log.Printf("- Code: %s, Language: %s, Count: %d", dup.Code, dup.Language, dup.Count)
+// execWithoutTimeouts runs a concurrent index statement with the session
+// timeouts lifted on a pinned connection. CREATE/DROP INDEX CONCURRENTLY wait
+// for every older transaction on the table and a long build is expected, so
+// cancelling them part way would only leave an invalid index behind
+func execWithoutTimeouts(db *gorm.DB, sql string) error {
+	return db.Connection(func(conn *gorm.DB) error {
+		if err := conn.Exec("SET statement_timeout = 0").Error; err != nil {
+			return err
 		}
-		log.Println("You may need to resolve these duplicates before the unique constraint can be properly enforced.")
-	} else {
-		log.Println("\nNo duplicate (code, language) combinations found. Constraint is properly enforced.")
-	}
+		if err := conn.Exec("SET lock_timeout = 0").Error; err != nil {
+			return err
+		}
+		if err := conn.Exec(sql).Error; err != nil {
+			return err
+		}
+		if err := conn.Exec("RESET statement_timeout").Error; err != nil {
+			return err
+		}
+		return conn.Exec("RESET lock_timeout").Error
+	})
+}
 
-	log.Println("\nConstraint fix completed successfully!")
-}
\ No newline at end of file
+// codeLangIndexState reports whether idx_code_lang exists on message_templates and is valid,
+// reading pg_class/pg_index directly rather than the pg_indexes view
+func codeLangIndexState(db *gorm.DB) (exists bool, valid bool, err error) {
+	var rows []struct {
+		Valid bool `gorm:"column:indisvalid"`
+	}
+	err = db.Raw(`
+		SELECT i.indisvalid
+		FROM pg_class c
+		JOIN pg_index i ON c.oid = i.indexrelid
+		WHERE c.relname = 'idx_code_lang'
+		AND c.relnamespace = 'public'::regnamespace
+		AND i.indrelid = 'public.message_templates'::regclass
+	`).Scan(&rows).Error
+	if err != nil || len(rows) == 0 {
+		return false, false, err
+	}
+	return true, rows[0].Valid, nil
+}